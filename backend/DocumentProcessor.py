@@ -1,10 +1,15 @@
-import pytesseract
-from fastapi import HTTPException
-from PIL import Image
-import io
 import os
+
+# Keep Tesseract single-threaded per worker; we scale by adding workers instead
+os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+
+from tesserocr import PyTessBaseAPI, PSM
+from fastapi import HTTPException
+import cv2
+import numpy as np
 import logging
-from typing import Dict, Any
+import threading
+from typing import Dict, Any, List, Tuple
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -13,24 +18,51 @@ logger = logging.getLogger(__name__)
 class DocumentProcessor:
     def __init__(self):
         self.supported_formats = ['.png', '.jpg', '.jpeg', '.pdf', '.tiff', '.bmp']
+        # PyTessBaseAPI is not thread-safe, so each thread gets its own instance
+        self._local = threading.local()
+
+    @property
+    def api(self) -> PyTessBaseAPI:
+        """Return this thread's Tesseract API, initializing it on first use"""
+        api = getattr(self._local, "api", None)
+        if api is None:
+            api = PyTessBaseAPI(psm=PSM.AUTO)
+            self._local.api = api
+        return api
+
+    def binarize(self, gray: np.ndarray) -> np.ndarray:
+        """Binarize a grayscale image so Tesseract can skip its own thresholding"""
+        return cv2.adaptiveThreshold(
+            gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 31, 10
+        )
+
+    def preprocess_image_file(self, file_path: str) -> np.ndarray:
+        """Load an image file straight to grayscale (no Python bytes copy) and binarize"""
+        gray = cv2.imread(file_path, cv2.IMREAD_GRAYSCALE)
+        if gray is None:
+            raise ValueError(f"Unable to read image file {file_path}")
+        return self.binarize(gray)
+
+    def recognize(self, image: np.ndarray) -> str:
+        """Run the in-process Tesseract API (no subprocess / model reload) on a preprocessed image"""
+        # Hand Tesseract the raw 8-bit grayscale buffer (1 byte per pixel) directly,
+        # avoiding a PIL round-trip and any RGB expansion
+        image = np.ascontiguousarray(image, dtype=np.uint8)
+        height, width = image.shape
+        api = self.api
+        api.SetImageBytes(image.tobytes(), width, height, 1, width)
+        return api.GetUTF8Text().strip()
     
-    def extract_text_from_image(self, image_bytes: bytes) -> str:
-        """Extract text from image using Tesseract OCR"""
+    def extract_text_from_file(self, file_path: str) -> str:
+        """Extract text from an image file on disk using Tesseract OCR"""
         try:
-            image = Image.open(io.BytesIO(image_bytes))
-            # Convert to RGB if necessary
-            if image.mode != 'RGB':
-                image = image.convert('RGB')
-            
-            # Use Tesseract to extract text
-            text = pytesseract.image_to_string(image)
-            return text.strip()
+            return self.recognize(self.preprocess_image_file(file_path))
         except Exception as e:
-            logger.error(f"OCR processing failed: {str(e)}")
+            logger.error("OCR processing failed: %s", e)
             raise HTTPException(status_code=500, detail=f"OCR processing failed: {str(e)}")
     
-    def process_document(self, file_content: bytes, filename: str) -> Dict[str, Any]:
-        """Process uploaded document and extract text"""
+    def validate_format(self, filename: str) -> str:
+        """Ensure the file extension is supported and return it"""
         file_ext = os.path.splitext(filename)[1].lower()
         
         if file_ext not in self.supported_formats:
@@ -44,15 +76,35 @@ class DocumentProcessor:
         if file_ext == '.pdf':
             raise HTTPException(status_code=400, detail="PDF support coming soon")
         
+        return file_ext
+    
+    def process_document_file(self, file_path: str, filename: str) -> Dict[str, Any]:
+        """Process a document already stored on disk and extract text"""
+        self.validate_format(filename)
+        
         # Extract text using OCR
-        extracted_text = self.extract_text_from_image(file_content)
+        extracted_text = self.extract_text_from_file(file_path)
         
         return {
             "filename": filename,
-            "file_size": len(file_content),
+            "file_size": os.path.getsize(file_path),
             "extracted_text": extracted_text,
             "text_length": len(extracted_text)
         }
+    
+    def process_documents(self, documents: List[Tuple[str, str]]) -> List[Dict[str, Any]]:
+        """OCR a batch of (file_path, filename) pairs on this thread's Tesseract API.
+
+        A failure on one document is reported in its result under "error"
+        instead of aborting the rest of the batch.
+        """
+        results = []
+        for file_path, filename in documents:
+            try:
+                results.append(self.process_document_file(file_path, filename))
+            except HTTPException as e:
+                results.append({"filename": filename, "error": e.detail})
+        return results
 
 # Initialize document processor
 doc_processor = DocumentProcessor()
\ No newline at end of file
@@ -1,11 +1,24 @@
 import redis
 import logging
 import json
-from openai import OpenAI, APIConnectionError, APIStatusError, RateLimitError, APITimeoutError
+import orjson
+import asyncio
+import random
+import re
+import httpx
+from openai import AsyncOpenAI, NOT_GIVEN, APIConnectionError, APIStatusError, RateLimitError, APITimeoutError, InternalServerError
 import os
 from dotenv import load_dotenv
-from prompts import OCR_Extraction_Prompt
+from redisvl.extensions.cache.llm import SemanticCache
+from redisvl.utils.vectorize import HFTextVectorizer
+from prompts import OCR_Extraction_Prompt, OCR_Extraction_Examples, Missing_Fields_Prompt, REFERRAL_SCHEMA
+from rate_limiter import RateLimiter
+from structured_extract import extract_structured_fields, merge_extraction, merge_fields, scrub_cached_extraction
+from DocumentProcessor import doc_processor
+from db import redis_client, redis_json, REDIS_URL, QUEUE_KEY, DOCUMENT_TTL, DOCUMENTS_INDEX_KEY
 import datetime
+import time
+import threading
 
 load_dotenv()
 
@@ -13,67 +26,398 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Define redis client
-redis_client = redis.Redis(host="localhost", port=6379, db=0, decode_responses=True)
-
 # Define OpenAI client
 try:
     OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-    logger.info("Key Extracted: %r", OPENAI_API_KEY)
-    openai_client = OpenAI(api_key=OPENAI_API_KEY)
+    # Retries are handled in chat_with_gpt4 so backoff is not applied twice, and one
+    # pooled HTTP client per process keeps TCP/TLS connections alive across requests
+    openai_client = AsyncOpenAI(
+        api_key=OPENAI_API_KEY,
+        max_retries=0,
+        http_client=httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20)
+        ),
+    )
     logger.info("OpenAI Client Created Successfully")
 except (APIConnectionError, APIStatusError, RateLimitError, APITimeoutError) as e:
     logger.error("OpenAI client initialization failed: %s", str(e))
     logger.exception(e)
 
+# Proactive throttling for the hosted model; set these to the account's limits
+OPENAI_MAX_REQUESTS_PER_MINUTE = float(os.getenv("OPENAI_MAX_REQUESTS_PER_MINUTE", "500"))
+OPENAI_MAX_TOKENS_PER_MINUTE = float(os.getenv("OPENAI_MAX_TOKENS_PER_MINUTE", "200000"))
+# Completion tokens budgeted per request, since responses are not length-capped
+EXPECTED_COMPLETION_TOKENS = 1000
+rate_limiter = RateLimiter(OPENAI_MAX_REQUESTS_PER_MINUTE, OPENAI_MAX_TOKENS_PER_MINUTE)
 
-# Attempt redis connection
-try:
-    redis_client.ping()
-    logger.info("Connected to Redis successfully")
-except redis.ConnectionError:
-    logger.error("Failed to connect to Redis")
-    raise
-
-
-def check_redis():
-    """Check Redis for a new document processing job."""
-    logger.debug("Checking Redis for new document processing job.")
-    queue_key = "document_processing_queue"
-    job_json = redis_client.rpop(queue_key)
-    if job_json is not None:
+
+def set_rate_limit_share(num_workers):
+    """Split the account's rate limits evenly across `num_workers` agent processes."""
+    global rate_limiter
+    rate_limiter = RateLimiter(
+        OPENAI_MAX_REQUESTS_PER_MINUTE / num_workers,
+        OPENAI_MAX_TOKENS_PER_MINUTE / num_workers
+    )
+
+
+# Optional local OpenAI-compatible model server (e.g. vLLM or Ollama) tried before
+# the hosted model; unset LOCAL_LLM_BASE_URL to always use the hosted model
+LOCAL_LLM_BASE_URL = os.getenv("LOCAL_LLM_BASE_URL")
+LOCAL_LLM_MODEL = os.getenv("LOCAL_LLM_MODEL", "meta-llama/Meta-Llama-3-8B-Instruct")
+local_llm_client = None
+if LOCAL_LLM_BASE_URL:
+    local_llm_client = AsyncOpenAI(
+        base_url=LOCAL_LLM_BASE_URL,
+        api_key=os.getenv("LOCAL_LLM_API_KEY", "EMPTY"),
+        max_retries=0,
+        http_client=httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20)
+        ),
+    )
+    logger.info("Local LLM client created for %s (%s)", LOCAL_LLM_BASE_URL, LOCAL_LLM_MODEL)
+
+# Semantic cache for LLM extractions: templated referral forms often produce
+# near-identical OCR text, so a vector lookup can stand in for a GPT call.
+# Keep the distance threshold tight - a loose match could return another
+# patient's referral.
+SEMANTIC_CACHE_DISTANCE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_DISTANCE_THRESHOLD", "0.1"))
+SEMANTIC_CACHE_TTL = 86400  # 24 hours
+
+# Built on first use: the embedding model costs each worker process several
+# hundred MB, and documents the parser fully handles never need it
+semantic_cache = None
+_semantic_cache_ready = False
+_semantic_cache_lock = threading.Lock()
+
+
+def get_semantic_cache():
+    """Return the semantic cache, loading its vectorizer on the first call (None if unavailable)."""
+    global semantic_cache, _semantic_cache_ready
+    with _semantic_cache_lock:
+        if _semantic_cache_ready:
+            return semantic_cache
+        try:
+            semantic_cache = SemanticCache(
+                name="referral_extract",
+                redis_url=REDIS_URL,
+                distance_threshold=SEMANTIC_CACHE_DISTANCE_THRESHOLD,
+                ttl=SEMANTIC_CACHE_TTL,
+                vectorizer=HFTextVectorizer("redis/langcache-embed-v2"),
+            )
+            logger.info("Semantic cache initialized")
+        except Exception as e:
+            # Requires Redis Stack (RediSearch); extraction still works without it
+            logger.warning("Semantic cache unavailable, continuing without it: %s", str(e))
+            semantic_cache = None
+        _semantic_cache_ready = True
+        return semantic_cache
+
+
+# Maximum number of jobs drained from the queue per poll
+BATCH_SIZE = 16
+
+# How long a blocking pop waits server-side before returning empty
+POLL_TIMEOUT_SECONDS = 5
+
+# Idle polling backoff bounds for an empty queue (RPOP fallback only)
+MIN_POLL_BACKOFF_SECONDS = 0.25
+MAX_POLL_BACKOFF_SECONDS = 16.0
+
+# Exact-duplicate uploads (same content hash) reuse earlier OCR + extraction results
+RESULT_CACHE_KEY_PREFIX = "ocr_cache:"
+RESULT_CACHE_TTL = 86400  # 24 hours
+
+# Restart backoff bounds for a crashed agent loop
+MIN_RESTART_BACKOFF_SECONDS = 1.0
+MAX_RESTART_BACKOFF_SECONDS = 60.0
+
+# Maximum number of documents processed (and OpenAI requests in flight) at once
+NUM_CONCURRENT = 10
+
+# Retry policy for transient OpenAI failures
+MAX_RETRIES = 5
+MAX_BACKOFF_SECONDS = 30.0
+
+
+# BLMPOP needs Redis >= 7.0; flipped off the first time the server rejects it
+blmpop_supported = True
+
+
+def check_redis(count=BATCH_SIZE):
+    """Check Redis for up to `count` new document processing jobs.
+
+    Uses BLMPOP to block server-side until jobs arrive (or POLL_TIMEOUT_SECONDS
+    elapses), falling back to a non-blocking RPOP with a count on older Redis.
+    """
+    global blmpop_supported
+    logger.debug("Checking Redis for new document processing jobs.")
+    queue_key = QUEUE_KEY
+    # Producers LPUSH, so popping from the right keeps jobs in FIFO order
+    jobs = None
+    if blmpop_supported:
+        try:
+            result = redis_client.blmpop(POLL_TIMEOUT_SECONDS, 1, queue_key, direction="RIGHT", count=count)
+            jobs = result[1] if result else None
+        except redis.ResponseError as e:
+            logger.warning("BLMPOP unavailable (%s), falling back to RPOP polling.", str(e))
+            blmpop_supported = False
+    if not blmpop_supported:
+        jobs = redis_client.rpop(queue_key, count)
+    if jobs:
         # Redis may return bytes, so decode if needed
-        if isinstance(job_json, bytes):
-            job_json = job_json.decode("utf-8")
-        logger.debug("Job found in Redis queue.")
-        return job_json
+        jobs = [job.decode("utf-8") if isinstance(job, bytes) else job for job in jobs]
+        logger.debug("%d job(s) found in Redis queue.", len(jobs))
+        return jobs
     logger.debug("No job found in Redis queue.")
-    return None
+    return []
+
+
+def check_result_cache(batch):
+    """Attach cached OCR + extraction results to jobs whose exact upload was seen before.
+
+    Returns the jobs that still need OCR.
+    """
+    hashed = [job_data for job_data in batch if job_data.get('content_hash')]
+    if not hashed:
+        return batch
+    # One round-trip for the whole batch
+    cached = redis_client.mget([f"{RESULT_CACHE_KEY_PREFIX}{job_data['content_hash']}" for job_data in hashed])
+    for job_data, value in zip(hashed, cached):
+        if value is None:
+            continue
+        result = orjson.loads(value)
+        logger.info("Result cache hit for document %s, skipping OCR and extraction",
+                    job_data.get('document_id', 'unknown'))
+        job_data['ocr_error'] = None
+        job_data['extracted_text'] = result['extracted_text']
+        job_data['text_length'] = len(result['extracted_text'])
+        job_data['cached_structured_data'] = result['structured_data']
+    return [job_data for job_data in batch if 'cached_structured_data' not in job_data]
+
+
+def store_result_cache(job_data, structured_data):
+    """Cache OCR + extraction results under the upload's content hash."""
+    content_hash = job_data.get('content_hash')
+    if not content_hash:
+        return
+    redis_client.setex(
+        f"{RESULT_CACHE_KEY_PREFIX}{content_hash}",
+        RESULT_CACHE_TTL,
+        orjson.dumps({"extracted_text": job_data.get('extracted_text', ''), "structured_data": structured_data})
+    )
+
+
+def remove_uploads(batch):
+    """Delete the uploaded files of a batch; once popped, nothing else will read them."""
+    for job_data in batch:
+        file_path = job_data.get('file_path')
+        if file_path and os.path.exists(file_path):
+            os.remove(file_path)
+
+
+def remove_unparseable_upload(document_data):
+    """Best-effort cleanup of the upload behind a queue item that is not valid JSON."""
+    text = document_data.decode("utf-8", "replace") if isinstance(document_data, bytes) else str(document_data)
+    doc_id = re.search(r'"document_id"\s*:\s*"([^"]+)"', text)
+    file_path = re.search(r'"file_path"\s*:\s*"([^"]+)"', text)
+    if not doc_id:
+        return
+    mark_processing_failed(doc_id.group(1), "Queue entry is not valid JSON")
+    # Only ever delete a file that is named after the document it claims to be
+    if file_path and os.path.basename(file_path.group(1)).startswith(doc_id.group(1)):
+        if os.path.exists(file_path.group(1)):
+            os.remove(file_path.group(1))
+
+
+def ocr_batch(batch):
+    """OCR a batch of queued jobs with a single Tesseract API, storing the text on each job."""
+    try:
+        to_ocr = check_result_cache(batch)
+        documents = [(job_data.get('file_path', ''), job_data.get('filename', '')) for job_data in to_ocr]
+
+        if documents:
+            logger.info("Running OCR on batch of %d document(s)", len(documents))
+            results = doc_processor.process_documents(documents)
+        else:
+            results = []
+
+        for job_data, result in zip(to_ocr, results):
+            job_data['ocr_error'] = result.get('error')
+            job_data['extracted_text'] = result.get('extracted_text', '')
+            job_data['text_length'] = result.get('text_length', 0)
+    finally:
+        # Remove the uploads even if the cache lookup or OCR raised
+        remove_uploads(batch)
+    return batch
+
+
+async def chat_with_gpt4(messages, model="gpt-4.1-nano", client=None, max_retries=MAX_RETRIES, response_format=None):
+    """Send messages to GPT-4 model and return the response content.
+
+    Transient errors (rate limits, timeouts, connection drops, 5xx) are
+    retried with exponential backoff plus jitter.
+    """
+    client = client or openai_client
+    # Only the hosted model is subject to account rate limits
+    limiter = rate_limiter if client is openai_client else None
+    if limiter is not None:
+        num_tokens = limiter.num_tokens_for_request(messages, EXPECTED_COMPLETION_TOKENS)
+    for attempt in range(max_retries):
+        try:
+            if limiter is not None:
+                await limiter.acquire(num_tokens)
+            logger.info("Calling OpenAI GPT-4 model with messages.")
+            response = await client.chat.completions.create(
+                model=model,
+                messages=messages,
+                response_format=response_format if response_format is not None else NOT_GIVEN
+            )
+            logger.info("Received response from GPT-4 model.")
+            return response.choices[0].message.content
+        except (RateLimitError, APITimeoutError, APIConnectionError, InternalServerError) as e:
+            if isinstance(e, RateLimitError) and limiter is not None:
+                limiter.on_rate_limited()
+            if attempt == max_retries - 1:
+                raise
+            delay = min(2 ** attempt, MAX_BACKOFF_SECONDS) + random.uniform(0, 1)
+            logger.warning("OpenAI request failed (%s), retrying in %.1fs", type(e).__name__, delay)
+            await asyncio.sleep(delay)
+
+
+def matches_schema(value, schema):
+    """Check `value` against the JSON Schema subset our Structured Outputs schemas use."""
+    kind = schema.get("type")
+    if kind == "object":
+        if not isinstance(value, dict):
+            return False
+        properties = schema.get("properties", {})
+        if any(key not in value for key in schema.get("required", [])):
+            return False
+        if schema.get("additionalProperties") is False and any(key not in properties for key in value):
+            return False
+        return all(matches_schema(value[key], sub) for key, sub in properties.items() if key in value)
+    if kind == "array":
+        return isinstance(value, list) and all(matches_schema(item, schema["items"]) for item in value)
+    if kind == "string":
+        return isinstance(value, str)
+    return True
+
+
+def is_valid_reply(response, response_format):
+    """Whether a JSON reply has the shape `response_format` asked for."""
+    data = json.loads(response)
+    if not isinstance(data, dict):
+        return False
+    if response_format and response_format.get("type") == "json_schema":
+        return matches_schema(data, response_format["json_schema"]["schema"])
+    return True
+
+
+async def chat_with_router(messages, response_format=None):
+    """Route a JSON-producing request to the local model first, falling back to the hosted model.
+
+    The hosted model is used when no local server is configured, when the local
+    call fails, or when its reply is not valid JSON of the requested shape (a
+    local server may ignore json_schema).
+    """
+    if local_llm_client is not None:
+        try:
+            response = await chat_with_gpt4(messages, model=LOCAL_LLM_MODEL, client=local_llm_client, max_retries=1,
+                                            response_format=response_format)
+            if response is not None:
+                if is_valid_reply(response, response_format):
+                    logger.info("Local model response accepted.")
+                    return response
+                logger.warning("Local model reply does not match the requested schema, falling back to hosted model.")
+        except json.JSONDecodeError:
+            logger.warning("Local model returned invalid JSON, falling back to hosted model.")
+        except (APIConnectionError, APIStatusError, APITimeoutError) as e:
+            logger.warning("Local model request failed (%s), falling back to hosted model.", type(e).__name__)
+    return await chat_with_gpt4(messages=messages, response_format=response_format)
+
+
+async def check_semantic_cache(raw_ocr_text):
+    """Return a cached extraction for near-identical OCR text, if any."""
+    # Loading the model blocks, so keep it off the event loop
+    cache = await asyncio.get_running_loop().run_in_executor(None, get_semantic_cache)
+    if cache is None:
+        return None
+    try:
+        hits = await cache.acheck(prompt=raw_ocr_text, num_results=1)
+    except Exception as e:
+        logger.warning("Semantic cache lookup failed: %s", str(e))
+        return None
+    if not hits:
+        logger.debug("Semantic cache miss.")
+        return None
+    logger.info("Semantic cache hit (distance %s).", hits[0].get("vector_distance"))
+    try:
+        return json.loads(hits[0]["response"])
+    except json.JSONDecodeError:
+        logger.error("Cached extraction is not valid JSON, ignoring it.")
+        return None
+
+
+async def store_semantic_cache(raw_ocr_text, response):
+    """Cache a successful extraction keyed by its OCR text."""
+    # Only reached after a lookup, which has already built the cache
+    cache = get_semantic_cache()
+    if cache is None:
+        return
+    try:
+        await cache.astore(prompt=raw_ocr_text, response=response)
+    except Exception as e:
+        logger.warning("Semantic cache store failed: %s", str(e))
 
 
-def chat_with_gpt4(messages, model="gpt-4.1-nano"):
-    """Send messages to GPT-4 model and return the response content."""
-    logger.info("Calling OpenAI GPT-4 model with messages.")
-    response = openai_client.chat.completions.create(
-        model=model,
-        messages=messages
+def build_extraction_request(raw_ocr_text, parsed, missing_fields):
+    """Build the user message, asking only for fields the parser could not find."""
+    if not parsed:
+        return raw_ocr_text
+    # Missing entries may carry a human-readable suffix, e.g. "x.contact (phone, ...)"
+    field_paths = [field.split(" ", 1)[0] for field in missing_fields]
+    return Missing_Fields_Prompt.format(
+        raw_ocr_text=raw_ocr_text,
+        extracted_fields=json.dumps(parsed),
+        missing_fields=", ".join(field_paths)
     )
-    logger.info("Received response from GPT-4 model.")
-    return response.choices[0].message.content
 
 
-def llm_assistend_extraction(raw_ocr_text):
-    """Extract structured data from raw OCR text using LLM."""
+async def llm_assistend_extraction(raw_ocr_text):
+    """Extract structured data from raw OCR text, using the LLM only for what regexes miss.
+
+    Returns (data, from_semantic_cache); data is None if extraction failed.
+    """
     logger.info("Starting LLM-assisted extraction.")
+    parsed = extract_structured_fields(raw_ocr_text)
+    is_complete, missing_fields = check_required_fields(parsed)
+    if is_complete:
+        logger.info("All required fields extracted deterministically, skipping LLM.")
+        return parsed, False
+    
+    cached = await check_semantic_cache(raw_ocr_text)
+    if cached is not None:
+        logger.info("LLM-assisted extraction served from semantic cache.")
+        # A hit may be another patient's form: keep only values this document
+        # shows, and only where the parser found nothing itself
+        return merge_fields(parsed, scrub_cached_extraction(cached, raw_ocr_text)), True
+    
     messages = [
         {"role": "system", "content": OCR_Extraction_Prompt},
-        {"role": "user", "content": raw_ocr_text}
+        *OCR_Extraction_Examples,
+        {"role": "user", "content": build_extraction_request(raw_ocr_text, parsed, missing_fields)}
     ]
     
-    response = chat_with_gpt4(messages=messages)
+    # Structured Outputs enforce the referral schema, so the prompt needn't spell it out
+    response = await chat_with_router(
+        messages=messages,
+        response_format={"type": "json_schema", "json_schema": REFERRAL_SCHEMA}
+    )
     try:
         if response != None:
-            data = json.loads(response)
+            data = merge_extraction(parsed, json.loads(response))
+            # Cache the merged result; the reply alone omits what the parser found
+            await store_semantic_cache(raw_ocr_text, json.dumps(data))
         else:
             data = None
     except json.JSONDecodeError:
@@ -82,57 +426,64 @@ def llm_assistend_extraction(raw_ocr_text):
         logger.info("Returned Text: %s", response)
         data = None
     logger.info("LLM-assisted extraction complete.")
+    return data, False
+
+
+REQUIRED_FIELDS = (
+    "referring_provider.name", 
+    "referring_provider.contact",
+    "receiving_provider.name",
+    "receiving_provider.contact",
+    "patient.name",
+    "patient.date_of_birth",
+    "reason_for_referral",
+    "requested_action"
+)
+
+# Split once at import instead of on every check
+REQUIRED_PATHS = tuple((field, tuple(field.split("."))) for field in REQUIRED_FIELDS)
+
+CONTACT_METHODS = ("phone", "email", "address")
+
+
+def _get(data, path):
+    """Walk a pre-split key path through nested dicts, returning None if it breaks."""
+    for key in path:
+        if not isinstance(data, dict):
+            return None
+        data = data.get(key)
+        if data is None:
+            return None
     return data
 
+
+def _is_empty(value):
+    """Only None and empty strings/collections count as missing (0 or False do not)."""
+    return value is None or (isinstance(value, (str, list, dict)) and len(value) == 0)
+
+
 def check_required_fields(data):
     """Check if all required fields are present and not empty."""
     logger.debug("Checking for required fields in extracted data.")
     if not data:
         return False, ["All fields - invalid JSON response"]
     
-    required_fields = [
-        "referring_provider.name", 
-        "referring_provider.contact",
-        "receiving_provider.name",
-        "receiving_provider.contact",
-        "patient.name",
-        "patient.date_of_birth",
-        "reason_for_referral",
-        "requested_action"
-    ]
-    
     missing_fields = []
     
-    for field in required_fields:
-        if "." in field:
-            # Handle nested fields
-            parts = field.split(".")
-            current = data
-            field_missing = False
-            
-            for part in parts:
-                if not isinstance(current, dict) or part not in current:
-                    field_missing = True
-                    break
-                current = current[part]
-            
-            if field_missing or not current or current == "":
-                missing_fields.append(field)
-            elif field.endswith(".contact"):
-                # Special check for contact fields - at least one contact method should be present
-                contact = current
-                if not any([contact.get("phone"), contact.get("email"), contact.get("address")]):
-                    missing_fields.append(field + " (phone, email, or address)")
-        else:
-            # Handle top-level fields
-            if field not in data or not data[field] or data[field] == "":
-                missing_fields.append(field)
+    for field, path in REQUIRED_PATHS:
+        value = _get(data, path)
+        if _is_empty(value):
+            missing_fields.append(field)
+        elif path[-1] == "contact" and isinstance(value, dict):
+            # Special check for contact fields - at least one contact method should be present
+            if all(_is_empty(value.get(method)) for method in CONTACT_METHODS):
+                missing_fields.append(field + " (phone, email, or address)")
     
     logger.debug("Required fields check complete. Missing fields: %s", missing_fields)
     return len(missing_fields) == 0, missing_fields
 
 
-def draft_request_email(missing_fields, referring_provider, receiving_provider, referral_id):
+async def draft_request_email(missing_fields, referring_provider, receiving_provider, referral_id):
     logger.info("Drafting request email for missing fields: %s", missing_fields)
     email_prompt = f"""
     You are a medical administrative assistant. Draft a professional email requesting missing information for a medical referral.
@@ -161,7 +512,7 @@ def draft_request_email(missing_fields, referring_provider, receiving_provider,
         {"role": "user", "content": email_prompt}
     ]
     
-    response = chat_with_gpt4(messages=messages)
+    response = await chat_with_router(messages=messages, response_format={"type": "json_object"})
     try:
         if response is not None:
             logger.info("Email draft received from LLM.")
@@ -208,13 +559,23 @@ def update_redis_status(doc_id, status, additional_info=None, structured_data=No
     """Update the document processing status in Redis."""
     logger.info("Updating Redis status for document %s to %s", doc_id, status)
     doc_key = f"document:{doc_id}"
-    status_data = {
-        "status": status,
-        "timestamp": datetime.datetime.now().isoformat(),
-        "additional_info": additional_info,
-        "structured_data": structured_data
-    }
-    redis_client.setex(doc_key, 3600, json.dumps(status_data))
+    # Path-level RedisJSON updates: only the changed fields go over the wire and
+    # the upload metadata stored under the same key is preserved
+    # Recreate the document only if it already expired; JSON.SET NX replies
+    # None when the key exists, so only a recreated document gets a fresh TTL
+    # (EXPIRE NX would do this in the pipeline but needs Redis >= 7.0) and is
+    # re-indexed, since the listing prunes index entries by their score
+    created = redis_json.set(doc_key, "$", {}, nx=True)
+    pipe = redis_json.pipeline()
+    if created:
+        pipe.expire(doc_key, DOCUMENT_TTL)
+        pipe.zadd(DOCUMENTS_INDEX_KEY, {doc_id: time.time()})
+    pipe.set(doc_key, "$.status", status)
+    pipe.set(doc_key, "$.timestamp", datetime.datetime.now().isoformat())
+    pipe.set(doc_key, "$.additional_info", additional_info)
+    if structured_data is not None:
+        pipe.set(doc_key, "$.structured_data", structured_data)
+    pipe.execute()
     logger.info("Redis status update complete for document %s.", doc_id)
 
 
@@ -238,97 +599,192 @@ def get_contact_info(provider_data):
 
 
 
-def main():
-    """Main loop for processing documents from the Redis queue."""
-    logger.info("Agent main loop started.")
-    while True:
-        logger.debug("Polling for new document in Redis queue.")
-        document_data = check_redis()
-        if document_data:
-            logger.info("Document data found. Beginning processing.")
-            try:
-                # Parse the document data
-                logger.debug("Parsing document data from Redis.")
-                job_data = json.loads(document_data)
-                doc_id = job_data.get('document_id', 'unknown')
-                raw_ocr_text = job_data.get('extracted_text', '')
-                
-                logger.info("Processing document %s", doc_id)
-                
-                # Extract structured data using LLM
-                logger.info("Extracting structured data for document %s", doc_id)
-                structured_data = llm_assistend_extraction(raw_ocr_text)
-                
-                if structured_data is None:
-                    logger.error("Failed to extract structured data for document %s", doc_id)
-                    update_redis_status(doc_id, "extraction_failed", "LLM extraction failed", structured_data=None)
-                    continue
-                
-                # Check for missing required fields
-                logger.info("Checking required fields for document %s", doc_id)
-                is_complete, missing_fields = check_required_fields(structured_data)
+async def process_job(job_data, semaphore):
+    """Run the agent workflow for a single OCR'd document."""
+    async with semaphore:
+        await _process_job(job_data)
+
+
+async def _process_job(job_data):
+    doc_id = job_data.get('document_id', 'unknown')
+    try:
+        raw_ocr_text = job_data.get('extracted_text', '')
+        
+        logger.info("Processing document %s", doc_id)
+        
+        if job_data.get('ocr_error'):
+            logger.error("OCR failed for document %s: %s", doc_id, job_data['ocr_error'])
+            update_redis_status(doc_id, "ocr_failed", job_data['ocr_error'], structured_data=None)
+            return
+        update_redis_status(doc_id, "ocr_complete", {"text_length": job_data.get('text_length', 0)})
+        
+        # Extract structured data using LLM
+        logger.info("Extracting structured data for document %s", doc_id)
+        if 'cached_structured_data' in job_data:
+            structured_data = job_data['cached_structured_data']
+        else:
+            structured_data, from_semantic_cache = await llm_assistend_extraction(raw_ocr_text)
+            # A semantic hit came from another document; don't replay it for this upload's bytes
+            if structured_data is not None and not from_semantic_cache:
+                store_result_cache(job_data, structured_data)
+        
+        if structured_data is None:
+            logger.error("Failed to extract structured data for document %s", doc_id)
+            update_redis_status(doc_id, "extraction_failed", "LLM extraction failed", structured_data=None)
+            return
+        
+        # Check for missing required fields
+        logger.info("Checking required fields for document %s", doc_id)
+        is_complete, missing_fields = check_required_fields(structured_data)
+        
+        if is_complete:
+            # All required fields are present - sync to EMR
+            logger.info("All required fields present for document %s. Syncing to EMR...", doc_id)
+            emr_result = mock_emr_sync(structured_data)
+            update_redis_status(doc_id, "emr_synced", emr_result, structured_data=structured_data)
+            logger.info("EMR sync complete for document %s", doc_id)
+        else:
+            # Missing fields detected - request additional information
+            logger.info("Missing fields detected for document %s: %s", doc_id, missing_fields)
+            
+            # Draft email requesting missing information
+            logger.info("Drafting email for missing fields for document %s", doc_id)
+            email_draft = await draft_request_email(
+                missing_fields,
+                structured_data.get('referring_provider', {}),
+                structured_data.get('receiving_provider', {}),
+                structured_data.get('referral_id', doc_id)
+            )
+            
+            if email_draft:
+                # Determine who to contact (prefer referring provider)
+                referring_provider = structured_data.get('referring_provider', {})
+                receiving_provider = structured_data.get('receiving_provider', {})
                 
-                if is_complete:
-                    # All required fields are present - sync to EMR
-                    logger.info("All required fields present for document %s. Syncing to EMR...", doc_id)
-                    emr_result = mock_emr_sync(structured_data)
-                    update_redis_status(doc_id, "emr_synced", emr_result, structured_data=structured_data)
-                    logger.info("EMR sync complete for document %s", doc_id)
-                else:
-                    # Missing fields detected - request additional information
-                    logger.info("Missing fields detected for document %s: %s", doc_id, missing_fields)
-                    
-                    # Draft email requesting missing information
-                    logger.info("Drafting email for missing fields for document %s", doc_id)
-                    email_draft = draft_request_email(
-                        missing_fields,
-                        structured_data.get('referring_provider', {}),
-                        structured_data.get('receiving_provider', {}),
-                        structured_data.get('referral_id', doc_id)
-                    )
-                    
-                    if email_draft:
-                        # Determine who to contact (prefer referring provider)
-                        referring_provider = structured_data.get('referring_provider', {})
-                        receiving_provider = structured_data.get('receiving_provider', {})
-                        
-                        contact_info = get_contact_info(referring_provider)
-                        if contact_info == "No contact information available":
-                            contact_info = get_contact_info(receiving_provider)
-                        
-                        # Send email
-                        logger.info("Sending email for missing fields for document %s", doc_id)
-                        email_result = mock_send_email(email_draft, contact_info)
-                        
-                        update_redis_status(doc_id, "missing_fields_email_sent", {
-                            "missing_fields": missing_fields,
-                            "email_result": email_result,
-                            "contact_info": contact_info
-                        }, structured_data=structured_data)
-                        logger.info("Missing fields email sent for document %s", doc_id)
-                    else:
-                        logger.error("Failed to draft email for document %s", doc_id)
-                        update_redis_status(doc_id, "email_draft_failed", {"missing_fields": missing_fields}, structured_data=structured_data)
+                contact_info = get_contact_info(referring_provider)
+                if contact_info == "No contact information available":
+                    contact_info = get_contact_info(receiving_provider)
                 
-                print(f"Processed document {doc_id}")
-                print(f"Structured data: {json.dumps(structured_data, indent=2)}")
-                logger.info("Processing complete for document %s", doc_id)
+                # Send email
+                logger.info("Sending email for missing fields for document %s", doc_id)
+                email_result = mock_send_email(email_draft, contact_info)
                 
-            except (json.JSONDecodeError, KeyError, TypeError) as e:
-                logger.error("Error processing document (JSON or dict error): %s", str(e))
-                logger.exception(e)
+                update_redis_status(doc_id, "missing_fields_email_sent", {
+                    "missing_fields": missing_fields,
+                    "email_result": email_result,
+                    "contact_info": contact_info
+                }, structured_data=structured_data)
+                logger.info("Missing fields email sent for document %s", doc_id)
+            else:
+                logger.error("Failed to draft email for document %s", doc_id)
+                update_redis_status(doc_id, "email_draft_failed", {"missing_fields": missing_fields}, structured_data=structured_data)
+        
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Structured data for document %s: %s", doc_id, json.dumps(structured_data, indent=2))
+        logger.info("Processing complete for document %s", doc_id)
+        
+    except Exception as e:
+        # Any failure (OpenAI, Redis, bad data) ends this document only, never the batch
+        logger.error("Error processing document %s: %s", doc_id, str(e))
+        logger.exception(e)
+        mark_processing_failed(doc_id, e)
+
+
+def mark_processing_failed(doc_id, error):
+    """Record a terminal status so a popped document is never left mid-pipeline."""
+    try:
+        update_redis_status(doc_id, "processing_failed", str(error), structured_data=None)
+    except Exception as e:
+        logger.error("Could not record failure for document %s: %s", doc_id, str(e))
+
+
+async def agent_loop(stop_event):
+    """Main loop for processing documents from the Redis queue until `stop_event` is set.
+
+    Blocking work (the BLMPOP wait and Tesseract OCR) runs in the default
+    executor so the loop can share an event loop with the API.
+    """
+    logger.info("Agent main loop started.")
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(NUM_CONCURRENT)
+    backoff = MIN_POLL_BACKOFF_SECONDS
+    while not stop_event.is_set():
+        logger.debug("Polling for new documents in Redis queue.")
+        documents = await loop.run_in_executor(None, check_redis)
+        if documents:
+            backoff = MIN_POLL_BACKOFF_SECONDS
+            logger.info("%d document(s) found. Beginning processing.", len(documents))
+            batch = []
+            for document_data in documents:
+                try:
+                    # Parse the document data
+                    logger.debug("Parsing document data from Redis.")
+                    batch.append(orjson.loads(document_data))
+                except orjson.JSONDecodeError as e:
+                    logger.error("Error processing document (JSON or dict error): %s", str(e))
+                    logger.exception(e)
+                    remove_unparseable_upload(document_data)
+            
+            try:
+                # OCR the whole batch on one Tesseract API before any LLM work,
+                # then run the LLM-bound workflow for every document concurrently
+                batch = await loop.run_in_executor(None, ocr_batch, batch)
             except Exception as e:
-                logger.error("Unexpected error processing document: %s", str(e))
+                logger.error("OCR failed for batch of %d document(s): %s", len(batch), str(e))
                 logger.exception(e)
-                raise
+                for job_data in batch:
+                    mark_processing_failed(job_data.get('document_id', 'unknown'), e)
+                continue
+            # _process_job handles its own errors; return_exceptions keeps one
+            # stray failure from abandoning the rest of the batch mid-flight
+            results = await asyncio.gather(
+                *[process_job(job_data, semaphore) for job_data in batch], return_exceptions=True
+            )
+            for job_data, result in zip(batch, results):
+                if isinstance(result, Exception):
+                    logger.error("Unexpected error processing document: %s", str(result))
+                    mark_processing_failed(job_data.get('document_id', 'unknown'), result)
             
-            # For now, break after handling current document
-            logger.info("Breaking after processing current document.")
+            logger.info("Finished processing batch of %d document(s).", len(batch))
+            continue
         
-        # Continue checking Redis (in production, you might want to add a small delay)
-        logger.debug("No document found, continuing to poll Redis queue.")
-        continue
+        # BLMPOP already waited server-side, so poll again straight away
+        if blmpop_supported:
+            continue
+        
+        # Queue is empty: back off exponentially (with jitter) before polling again
+        logger.debug("No document found, polling Redis queue again in %.2fs.", backoff)
+        try:
+            await asyncio.wait_for(stop_event.wait(), backoff + random.uniform(0, 0.05))
+        except asyncio.TimeoutError:
+            pass
+        backoff = min(backoff * 2, MAX_POLL_BACKOFF_SECONDS)
     logger.info("Agent main loop ended.")
+
+
+async def supervise_agent_loop(stop_event, worker_id=0):
+    """Run agent_loop, restarting it with exponential backoff if it crashes."""
+    backoff = MIN_RESTART_BACKOFF_SECONDS
+    while not stop_event.is_set():
+        started = time.monotonic()
+        try:
+            logger.info("Starting agent worker %d", worker_id)
+            await agent_loop(stop_event)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error("Agent worker %d crashed: %s", worker_id, str(e))
+            logger.exception(e)
+            # A worker that stayed up for a while earns a fresh backoff
+            if time.monotonic() - started > MAX_RESTART_BACKOFF_SECONDS:
+                backoff = MIN_RESTART_BACKOFF_SECONDS
+            logger.info("Restarting agent worker %d in %.1fs", worker_id, backoff)
+            try:
+                await asyncio.wait_for(stop_event.wait(), backoff)
+            except asyncio.TimeoutError:
+                pass
+            backoff = min(backoff * 2, MAX_RESTART_BACKOFF_SECONDS)
+    logger.info("Agent worker %d stopped.", worker_id)
     
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    asyncio.run(supervise_agent_loop(asyncio.Event()))
\ No newline at end of file
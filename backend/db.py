@@ -0,0 +1,63 @@
+import redis
+import orjson
+import os
+import logging
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
+REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
+REDIS_DB = int(os.getenv("REDIS_DB", "0"))
+REDIS_URL = f"redis://{REDIS_HOST}:{REDIS_PORT}/{REDIS_DB}"
+
+# Queue the API pushes uploads onto and the agent pops from
+QUEUE_KEY = "document_processing_queue"
+
+# Document status keys expire after this many seconds
+DOCUMENT_TTL = 3600
+
+# Sorted set of document IDs scored by upload time, so listing documents
+# never needs a KEYS scan
+DOCUMENTS_INDEX_KEY = "documents:index"
+
+# One connection pool per process, shared by the API and the agent
+redis_pool = redis.ConnectionPool(
+    host=REDIS_HOST,
+    port=REDIS_PORT,
+    db=REDIS_DB,
+    decode_responses=True,
+    max_connections=32,
+)
+redis_client = redis.Redis(connection_pool=redis_pool)
+
+
+
+class OrjsonEncoder:
+    """Encoder shim so RedisJSON commands serialize with orjson."""
+
+    def encode(self, obj):
+        return orjson.dumps(obj)
+
+
+class OrjsonDecoder:
+    """Decoder shim so RedisJSON replies are parsed with orjson."""
+
+    def decode(self, s):
+        return orjson.loads(s)
+
+
+# RedisJSON command interface for document status values
+redis_json = redis_client.json(encoder=OrjsonEncoder(), decoder=OrjsonDecoder())
+
+# Attempt redis connection
+try:
+    redis_client.ping()
+    logger.info("Connected to Redis successfully")
+except redis.ConnectionError:
+    logger.error("Failed to connect to Redis")
+    raise
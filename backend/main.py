@@ -1,17 +1,21 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException
+from fastapi import FastAPI, File, UploadFile, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-import redis
-import json
+from fastapi.responses import JSONResponse
+import orjson
 import uuid
+import hashlib
+import aiofiles
 from datetime import datetime
 import logging
 from typing import cast, List, Dict, Any
 from DocumentProcessor import doc_processor
+from db import redis_client, redis_json, QUEUE_KEY, DOCUMENT_TTL, DOCUMENTS_INDEX_KEY
+from worker import run_agent_loop
+from multiprocessing.process import BaseProcess
 import asyncio
+import multiprocessing
 import threading
-import subprocess
 import time
-import sys
 import os
 
 # Configure logging
@@ -20,6 +24,17 @@ logger = logging.getLogger(__name__)
 
 app = FastAPI(title="Referral Queuing Service")
 
+@app.middleware("http")
+async def limit_upload_size(request: Request, call_next):
+    """Reject oversized uploads by their declared length before FastAPI parses the form."""
+    if request.method == "POST" and request.url.path == "/upload-document":
+        content_length = request.headers.get("content-length")
+        # Allow for the multipart boundaries and part headers around the file
+        limit = MAX_UPLOAD_BYTES + UPLOAD_FORM_OVERHEAD_BYTES
+        if content_length is not None and content_length.isdigit() and int(content_length) > limit:
+            return JSONResponse(status_code=413, content={"detail": f"File too large. Maximum size: {MAX_UPLOAD_BYTES} bytes"})
+    return await call_next(request)
+
 # CORS middleware for NextJS frontend
 app.add_middleware(
     CORSMiddleware,
@@ -29,108 +44,164 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Redis connection
-redis_client = redis.Redis(host='localhost', port=6379, db=0, decode_responses=True)
+# Uploaded files wait here until an agent worker OCRs them
+UPLOAD_DIR = os.getenv("UPLOAD_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "uploads"))
+
+# Uploads larger than this are rejected; they are streamed to disk in chunks
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(20 * 1024 * 1024)))
+UPLOAD_CHUNK_BYTES = 1 << 20
+UPLOAD_FORM_OVERHEAD_BYTES = 64 * 1024
+
+# One agent worker process per core, capped by default; OCR is CPU-bound and
+# the GIL would serialize it across threads, but every worker also holds its
+# own Tesseract API and embedding model (roughly 0.5-1 GB each)
+DEFAULT_MAX_AGENT_WORKERS = 4
+AGENT_WORKERS = int(os.getenv("AGENT_WORKERS", str(min(os.cpu_count() or 1, DEFAULT_MAX_AGENT_WORKERS))))
 
-# Test Redis connection
-try:
-    redis_client.ping()
-    logger.info("Connected to Redis successfully")
-except redis.ConnectionError:
-    logger.error("Failed to connect to Redis")
-    raise
+# Upload metadata kept on the document for the workers, never returned to clients
+PRIVATE_DOCUMENT_FIELDS = ("file_path", "content_hash")
 
-# --- Agent Manager for running agent.py as a worker thread ---
+# Restart backoff bounds for an exited worker process, and how long to wait
+# for workers to finish their current poll on shutdown
+MIN_AGENT_RESTART_BACKOFF_SECONDS = 1.0
+MAX_AGENT_RESTART_BACKOFF_SECONDS = 60.0
+AGENT_SHUTDOWN_TIMEOUT_SECONDS = 10
+
+# --- Agent Manager for running the agent loop in worker processes ---
 class AgentManager:
     def __init__(self, num_workers=1):
         self.num_workers = num_workers
-        self.workers = []
+        self.workers: List[threading.Thread] = []
+        self.processes: Dict[int, BaseProcess] = {}
         self.running = False
+        # Spawn (not fork) so each worker starts with a clean interpreter and
+        # builds its own Tesseract API, Redis pool and OpenAI client
+        self.ctx = multiprocessing.get_context("spawn")
+        self.shutdown_event = self.ctx.Event()
 
     def start_agents(self):
         self.running = True
+        self.shutdown_event.clear()
         for i in range(self.num_workers):
             t = threading.Thread(target=self._run_agent, args=(i,), daemon=True)
             t.start()
             self.workers.append(t)
 
     def _run_agent(self, worker_id):
+        """Keep one worker process alive, restarting it with exponential backoff if it exits."""
+        backoff = MIN_AGENT_RESTART_BACKOFF_SECONDS
         while self.running:
-            try:
-                print(f"Starting agent worker {worker_id}")
-                proc = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(__file__), "agent.py")])
-                proc.wait()
-                print(f"Agent worker {worker_id} exited with code {proc.returncode}, restarting in 2s...")
-                time.sleep(2)
-            except Exception as e:
-                print(f"Agent worker {worker_id} crashed: {e}, restarting in 2s...")
-                time.sleep(2)
+            started = time.monotonic()
+            logger.info("Starting agent worker process %d", worker_id)
+            proc = self.ctx.Process(
+                target=run_agent_loop,
+                args=(worker_id, self.shutdown_event, self.num_workers),
+                daemon=True
+            )
+            proc.start()
+            self.processes[worker_id] = proc
+            proc.join()
+            if not self.running:
+                break
+            # A worker that stayed up for a while earns a fresh backoff
+            if time.monotonic() - started > MAX_AGENT_RESTART_BACKOFF_SECONDS:
+                backoff = MIN_AGENT_RESTART_BACKOFF_SECONDS
+            logger.warning("Agent worker %d exited with code %s, restarting in %.1fs", worker_id, proc.exitcode, backoff)
+            time.sleep(backoff)
+            backoff = min(backoff * 2, MAX_AGENT_RESTART_BACKOFF_SECONDS)
 
     def stop_agents(self):
         self.running = False
-        # Optionally: send a signal to subprocesses to terminate
+        self.shutdown_event.set()
+        # Give workers time to finish their current poll, then terminate stragglers
+        for proc in self.processes.values():
+            proc.join(timeout=AGENT_SHUTDOWN_TIMEOUT_SECONDS)
+            if proc.is_alive():
+                proc.terminate()
+        self.processes = {}
+        self.workers = []
 
 # Instantiate and start the agent manager on FastAPI startup
-agent_manager = AgentManager(num_workers=1)
-
-def start_agent_manager():
-    agent_manager.start_agents()
+agent_manager = AgentManager(num_workers=AGENT_WORKERS)
 
 @app.on_event("startup")
 def on_startup():
-    start_agent_manager()
+    agent_manager.start_agents()
+
+@app.on_event("shutdown")
+def on_shutdown():
+    agent_manager.stop_agents()
 
 @app.post("/upload-document")
 async def upload_document(file: UploadFile = File(...)):
     """
-    Upload and process a medical document
+    Upload a medical document and queue it for OCR and agent processing
     """
     try:
         # Generate unique document ID
         doc_id = str(uuid.uuid4())
         
-        # Read file content
-        file_content = await file.read()
-        
-        # Process document with OCR
-        logger.info(f"Processing document: {file.filename}")
+        # Reject unsupported formats before touching the body
         filename = file.filename if file.filename is not None else ""
-        processing_result = doc_processor.process_document(file_content, filename)
-        
-        # Create job data for Redis queue
-        job_data = {
-            "document_id": doc_id,
-            "filename": processing_result["filename"],
-            "file_size": processing_result["file_size"],
-            "extracted_text": processing_result["extracted_text"],
-            "text_length": processing_result["text_length"],
-            "upload_timestamp": datetime.now().isoformat(),
-            "status": "ocr_complete",
-            "next_step": "agent_processing"
-        }
-        
-        # Store in Redis queue for agent processing
-        queue_key = "document_processing_queue"
-        redis_client.lpush(queue_key, json.dumps(job_data))
+        file_ext = doc_processor.validate_format(filename)
         
-        # Also store document metadata for status tracking
-        doc_key = f"document:{doc_id}"
-        redis_client.setex(doc_key, 3600, json.dumps(job_data))  # Expire in 1 hour
+        # Stream the upload to disk in chunks and hand it to the agent worker; OCR runs there
+        logger.info("Queueing document: %s", file.filename)
+        os.makedirs(UPLOAD_DIR, exist_ok=True)
+        file_path = os.path.join(UPLOAD_DIR, f"{doc_id}{file_ext}")
+        try:
+            file_size = 0
+            # Hash while streaming so duplicate uploads can reuse cached results
+            hasher = hashlib.blake2b(digest_size=32)
+            async with aiofiles.open(file_path, "wb") as f:
+                while chunk := await file.read(UPLOAD_CHUNK_BYTES):
+                    file_size += len(chunk)
+                    if file_size > MAX_UPLOAD_BYTES:
+                        raise HTTPException(status_code=413, detail=f"File too large. Maximum size: {MAX_UPLOAD_BYTES} bytes")
+                    hasher.update(chunk)
+                    await f.write(chunk)
+            
+            # Create job data for Redis queue
+            job_data = {
+                "document_id": doc_id,
+                "filename": filename,
+                "file_size": file_size,
+                "file_path": file_path,
+                "content_hash": hasher.hexdigest(),
+                "upload_timestamp": datetime.now().isoformat(),
+                "status": "uploaded",
+                "next_step": "ocr_processing"
+            }
+            
+            # Store the document as a RedisJSON value for status tracking, index it,
+            # and queue it for agent processing in one atomic round-trip
+            queue_key = QUEUE_KEY
+            doc_key = f"document:{doc_id}"
+            pipe = redis_json.pipeline()
+            pipe.set(doc_key, "$", job_data)
+            pipe.expire(doc_key, DOCUMENT_TTL)  # Expire in 1 hour; status updates keep this TTL
+            pipe.zadd(DOCUMENTS_INDEX_KEY, {doc_id: time.time()})
+            pipe.lpush(queue_key, orjson.dumps(job_data))
+            pipe.execute()
+        except BaseException:
+            # Nothing was queued, so no worker will ever pick this file up
+            if os.path.exists(file_path):
+                os.remove(file_path)
+            raise
         
-        logger.info(f"Document {doc_id} queued for agent processing")
+        logger.info("Document %s queued for OCR and agent processing", doc_id)
         
         return {
             "document_id": doc_id,
             "status": "uploaded_and_queued",
-            "message": "Document processed with OCR and queued for agent",
-            "extracted_text_preview": processing_result["extracted_text"][:200] + "..." if len(processing_result["extracted_text"]) > 200 else processing_result["extracted_text"],
-            "text_length": processing_result["text_length"]
+            "message": "Document queued for OCR and agent processing",
+            "file_size": file_size
         }
         
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Unexpected error processing document: {str(e)}")
+        logger.error("Unexpected error processing document: %s", e)
         raise HTTPException(status_code=500, detail=f"Processing failed: {str(e)}")
 
 @app.get("/document/{document_id}/status")
@@ -140,14 +211,12 @@ async def get_document_status(document_id: str):
     """
     try:
         doc_key = f"document:{document_id}"
-        doc_data = redis_client.get(doc_key)
-        # If doc_data is awaitable, resolve it
-        if hasattr(doc_data, "__await__"):
-            doc_data = asyncio.get_event_loop().run_until_complete(doc_data)
-        if not isinstance(doc_data, str):
-            logger.error(f"doc_data for {doc_key} is not a string: {type(doc_data)}")
+        data = redis_json.get(doc_key)
+        if data is None:
+            raise HTTPException(status_code=404, detail="Document not found")
+        if not isinstance(data, dict):
+            logger.error("doc_data for %s is not an object: %s", doc_key, type(data))
             raise HTTPException(status_code=500, detail="Corrupt document data in Redis")
-        data = json.loads(doc_data)
         response = {
             "status": data.get("status"),
             "timestamp": data.get("timestamp"),
@@ -158,7 +227,7 @@ async def get_document_status(document_id: str):
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Error retrieving document status: {str(e)}")
+        logger.error("Error retrieving document status: %s", e)
         raise HTTPException(status_code=500, detail="Failed to retrieve document status")
 
 @app.get("/queue/status")
@@ -167,7 +236,7 @@ async def get_queue_status():
     Get the current status of the processing queue
     """
     try:
-        queue_key = "document_processing_queue"
+        queue_key = QUEUE_KEY
         queue_length = cast(int, redis_client.llen(queue_key))
         
         return {
@@ -176,7 +245,7 @@ async def get_queue_status():
         }
         
     except Exception as e:
-        logger.error(f"Error retrieving queue status: {str(e)}")
+        logger.error("Error retrieving queue status: %s", e)
         raise HTTPException(status_code=500, detail="Failed to retrieve queue status")
 
 @app.get("/documents/all")
@@ -185,44 +254,44 @@ def get_all_documents_in_queue():
     Get all documents currently in the Redis queue and their status.
     """
     try:
-        queue_key = "document_processing_queue"
+        queue_key = QUEUE_KEY
         queue_items = redis_client.lrange(queue_key, 0, -1)
         # If queue_items is awaitable, resolve it
         import asyncio
         if not isinstance(queue_items, list) and hasattr(queue_items, "__await__"):
             queue_items = asyncio.get_event_loop().run_until_complete(queue_items)
         if not isinstance(queue_items, list):
-            logger.error(f"queue_items is not a list after resolving: {type(queue_items)}")
+            logger.error("queue_items is not a list after resolving: %s", type(queue_items))
             return {"documents": [], "count": 0}
         documents: List[Dict[str, Any]] = []
         for item in queue_items:
             try:
                 if not isinstance(item, str):
-                    logger.error(f"Queue item is not a string: {type(item)}")
+                    logger.error("Queue item is not a string: %s", type(item))
                     continue
-                job_data = json.loads(item)
-                doc_id = job_data.get("document_id")
-                # Try to get status from the status key if available
-                doc_key = f"document:{doc_id}"
-                status_data = redis_client.get(doc_key)
-                if hasattr(status_data, "__await__"):
-                    status_data = asyncio.get_event_loop().run_until_complete(status_data)
-                if not isinstance(status_data, str):
-                    logger.error(f"Status data for {doc_key} is not a string: {type(status_data)}")
-                    status = None
-                else:
-                    try:
-                        status = json.loads(status_data).get("status")
-                    except Exception:
-                        status = None
-                job_data["current_status"] = status
+                job_data = orjson.loads(item)
+                for key in PRIVATE_DOCUMENT_FIELDS:
+                    job_data.pop(key, None)
                 documents.append(job_data)
             except Exception as e:
-                logger.error(f"Error parsing job data from queue: {str(e)}")
+                logger.error("Error parsing job data from queue: %s", e)
                 continue
+        if not documents:
+            return {"documents": [], "count": 0}
+        # Fetch just the status field of every document in a single round-trip
+        doc_keys = [f"document:{job_data.get('document_id')}" for job_data in documents]
+        statuses = cast(List[Any], redis_json.mget(doc_keys, "$.status"))
+        for job_data, doc_key, status_data in zip(documents, doc_keys, statuses):
+            # JSONPath results come back as a (possibly empty) list per key
+            if not status_data:
+                logger.error("No status found for %s", doc_key)
+                status = None
+            else:
+                status = status_data[0]
+            job_data["current_status"] = status
         return {"documents": documents, "count": len(documents)}
     except Exception as e:
-        logger.error(f"Error retrieving all documents in queue: {str(e)}")
+        logger.error("Error retrieving all documents in queue: %s", e)
         raise HTTPException(status_code=500, detail="Failed to retrieve all documents in queue")
 
 @app.get("/documents/status/all")
@@ -231,32 +300,33 @@ def get_all_document_statuses():
     Get the status and metadata for all documents in the system.
     """
     try:
-        doc_keys = redis_client.keys("document:*")
-        if hasattr(doc_keys, "__await__"):
-            doc_keys = asyncio.get_event_loop().run_until_complete(doc_keys)
-        if not isinstance(doc_keys, list):
-            logger.error(f"doc_keys is not a list after resolving: {type(doc_keys)}")
+        # Drop index entries whose status key has certainly expired
+        redis_client.zremrangebyscore(DOCUMENTS_INDEX_KEY, "-inf", time.time() - DOCUMENT_TTL)
+        doc_ids = cast(List[str], redis_client.zrange(DOCUMENTS_INDEX_KEY, 0, -1))
+        if not doc_ids:
             return {"documents": [], "count": 0}
+        # Fetch every status in a single round-trip
+        values = cast(List[Any], redis_json.mget([f"document:{doc_id}" for doc_id in doc_ids], "$"))
         documents = []
-        for key in doc_keys:
-            value = redis_client.get(key)
-            if hasattr(value, "__await__"):
-                value = asyncio.get_event_loop().run_until_complete(value)
-            if isinstance(value, bytes):
-                value = value.decode("utf-8")
-            if not isinstance(value, str):
-                logger.error(f"Value for {key} is not a string: {type(value)}")
+        expired_ids = []
+        for doc_id, value in zip(doc_ids, values):
+            if value is None:
+                expired_ids.append(doc_id)
                 continue
-            try:
-                doc_data = json.loads(value)
-                doc_data["document_id"] = key.split("document:")[1]
-                documents.append(doc_data)
-            except Exception as e:
-                logger.error(f"Error parsing document data for {key}: {str(e)}")
+            # JSONPath results come back as a list with the root object
+            if not value or not isinstance(value[0], dict):
+                logger.error("Document data for document:%s is not an object: %r", doc_id, value)
                 continue
+            doc_data = value[0]
+            for key in PRIVATE_DOCUMENT_FIELDS:
+                doc_data.pop(key, None)
+            doc_data["document_id"] = doc_id
+            documents.append(doc_data)
+        if expired_ids:
+            redis_client.zrem(DOCUMENTS_INDEX_KEY, *expired_ids)
         return {"documents": documents, "count": len(documents)}
     except Exception as e:
-        logger.error(f"Error retrieving all document statuses: {str(e)}")
+        logger.error("Error retrieving all document statuses: %s", e)
         raise HTTPException(status_code=500, detail="Failed to retrieve all document statuses")
 
 
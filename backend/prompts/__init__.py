@@ -1 +1,2 @@
-from .ocr_extraction_prompt import OCR_Extraction_Prompt
\ No newline at end of file
+from .ocr_extraction_prompt import OCR_Extraction_Prompt, OCR_Extraction_Examples, Missing_Fields_Prompt
+from .referral_schema import REFERRAL_SCHEMA
\ No newline at end of file
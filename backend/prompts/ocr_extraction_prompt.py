@@ -1,88 +1,69 @@
+import json
+
 OCR_Extraction_Prompt = (
     """
-    You are an expert data extraction assistant. Your task is to analyze the provided RAW OCR output of a medical referral document and extract all relevant information into a structured JSON format. Carefully review the OCR text and populate the following fields based on the available data. If any field is missing or cannot be determined, use an empty string (””) or an empty array ([]), as appropriate.
+    You are an expert data extraction assistant. Extract the information in the RAW OCR output of a medical referral document into the provided JSON schema.
 
-    Required fields to extract:
+    Instructions:
+    • Use only information present in the document; lives are at stake, so do not make anything up.
+    • If a field is missing or cannot be determined, use "" for strings or [] for arrays.
+    • Normalize dates to YYYY-MM-DD.
+    """
+)
 
+# One worked example (user OCR text -> assistant JSON) sent ahead of the real document
+OCR_Extraction_Examples = [
     {
-        “referral_id”: “string”,                // Unique identifier for the referral
-        “date_of_referral”: “YYYY-MM-DD”,       // Date the referral was created
-
-        “referring_provider”: {
-        “name”: “string”,
-        “provider_id”: “string”,
-        “specialty”: “string”,
-        “contact”: {
-            “phone”: “string”,
-            “email”: “string”,
-            “address”: “string”
-            }
-        },
-
-        “receiving_provider”: {
-            “name”: “string”,
-            “provider_id”: “string”,
-            “specialty”: “string”,
-            “contact”: {
-                “phone”: “string”,
-                “email”: “string”,
-                “address”: “string”
-            }
-        },
-
-        “patient”: {
-            “name”: “string”,
-            “date_of_birth”: “YYYY-MM-DD”,
-            “gender”: “string”,
-            “patient_id”: “string”,
-            “contact”: {
-            “phone”: “string”,
-            “email”: “string”,
-            “address”: “string”
+        "role": "user",
+        "content": (
+            "REFERRAL #R-1042  Date: 02/03/2024\n"
+            "From: Dr. Ana Ruiz, Family Medicine, (555) 201-3344\n"
+            "To: Dr. Ken Obi, Cardiology\n"
+            "Patient: Maria Chen  DOB: 07/19/1958\n"
+            "Palpitations and abnormal ECG. Please evaluate for arrhythmia."
+        ),
+    },
+    {
+        "role": "assistant",
+        "content": json.dumps({
+            "referral_id": "R-1042",
+            "date_of_referral": "2024-02-03",
+            "referring_provider": {
+                "name": "Dr. Ana Ruiz", "provider_id": "", "specialty": "Family Medicine",
+                "contact": {"phone": "(555) 201-3344", "email": "", "address": ""}
+            },
+            "receiving_provider": {
+                "name": "Dr. Ken Obi", "provider_id": "", "specialty": "Cardiology",
+                "contact": {"phone": "", "email": "", "address": ""}
+            },
+            "patient": {
+                "name": "Maria Chen", "date_of_birth": "1958-07-19", "gender": "", "patient_id": "",
+                "contact": {"phone": "", "email": "", "address": ""},
+                "insurance": {"provider": "", "policy_number": ""}
             },
-            “insurance”: {
-                “provider”: “string”,
-                “policy_number”: “string”
-            }
-        },
+            "reason_for_referral": "Palpitations and abnormal ECG",
+            "diagnosis": "",
+            "medications": [],
+            "allergies": [],
+            "recent_investigations": [{"test_name": "ECG", "date": "", "result": "abnormal"}],
+            "requested_action": "Please evaluate for arrhythmia.",
+            "attachments": [],
+            "notes": "",
+            "summary": "Referred to cardiology for evaluation of possible arrhythmia given palpitations and an abnormal ECG."
+        }),
+    },
+]
 
-        “reason_for_referral”: “string”,
-        
-        “diagnosis”: “string”,
-        “medications”: [
-            {
-            “name”: “string”,
-            “dosage”: “string”,
-            “frequency”: “string”
-            }
-            ],
-        “allergies”: [
-            “string”
-        ],
-        “recent_investigations”: [
-            {
-            “test_name”: “string”,
-            “date”: “YYYY-MM-DD”,
-            “result”: “string”
-            }
-        ],
-        “requested_action”: “string”. (Additional Instruction: Extract verbatim request for action otherwise if absent, use your context to extract the correct requested action from the data (you may have to weave together data) but remember you are a medical assistant and lives are at stake, so do not make up information. Use only what information you have.),
-        “attachments”: [
-        {
-        “type”: “string”,
-        “file_url”: “string”
-        }
-        ],
-        “notes”: “string”
-        "summary": "string" Use the context from this document and summurize why this patient is being referred for care
-    }
 
-    Instructions:
-    • Extract all fields and any additional relevant details present in the OCR output.
-    • If a field is missing or not explicitly stated, use “” for strings or [] for arrays.
-    • Only output the completed JSON object, with no extra commentary or explanation.
-    • Ensure the JSON structure matches the schema above.
+Missing_Fields_Prompt = (
+    """
+    {raw_ocr_text}
+
+    ---
+    The following fields were already extracted from this document and need not be repeated:
+    {extracted_fields}
 
-    Begin extraction using the above schema.
+    Extract ONLY these remaining fields and leave every other field empty ("" or []):
+    {missing_fields}
     """
-)
\ No newline at end of file
+)
@@ -0,0 +1,81 @@
+def _object(properties):
+    """Strict Structured Outputs object: every property required, nothing extra allowed."""
+    return {
+        "type": "object",
+        "properties": properties,
+        "required": list(properties),
+        "additionalProperties": False,
+    }
+
+
+def _string(description=None):
+    schema = {"type": "string"}
+    if description:
+        schema["description"] = description
+    return schema
+
+
+def _array(items):
+    return {"type": "array", "items": items}
+
+
+_DATE = "Date as YYYY-MM-DD, or empty string if absent"
+
+_CONTACT = _object({
+    "phone": _string(),
+    "email": _string(),
+    "address": _string(),
+})
+
+_PROVIDER = _object({
+    "name": _string(),
+    "provider_id": _string(),
+    "specialty": _string(),
+    "contact": _CONTACT,
+})
+
+
+# json_schema payload for response_format={"type": "json_schema", ...}
+REFERRAL_SCHEMA = {
+    "name": "referral_extraction",
+    "strict": True,
+    "schema": _object({
+        "referral_id": _string("Unique identifier for the referral"),
+        "date_of_referral": _string(_DATE),
+        "referring_provider": _PROVIDER,
+        "receiving_provider": _PROVIDER,
+        "patient": _object({
+            "name": _string(),
+            "date_of_birth": _string(_DATE),
+            "gender": _string(),
+            "patient_id": _string(),
+            "contact": _CONTACT,
+            "insurance": _object({
+                "provider": _string(),
+                "policy_number": _string(),
+            }),
+        }),
+        "reason_for_referral": _string(),
+        "diagnosis": _string(),
+        "medications": _array(_object({
+            "name": _string(),
+            "dosage": _string(),
+            "frequency": _string(),
+        })),
+        "allergies": _array(_string()),
+        "recent_investigations": _array(_object({
+            "test_name": _string(),
+            "date": _string(_DATE),
+            "result": _string(),
+        })),
+        "requested_action": _string(
+            "Verbatim requested action; if absent, infer it only from information in the document"
+        ),
+        "attachments": _array(_object({
+            "type": _string(),
+            "file_url": _string(),
+        })),
+        "notes": _string(),
+        "summary": _string("Why this patient is being referred for care, summarized from the document"),
+    }),
+}
@@ -0,0 +1,75 @@
+import asyncio
+import logging
+import time
+from typing import Any, Dict, List
+
+import tiktoken
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class RateLimiter:
+    """Token bucket admitting OpenAI requests only while request and token budget remain.
+
+    Capacity is spent when a request is issued and refills continuously at
+    max_*_per_minute / 60 per second, following the OpenAI cookbook's
+    api_request_parallel_processor throttling.
+    """
+
+    def __init__(self, max_requests_per_minute: float, max_tokens_per_minute: float, model: str = "gpt-4.1-nano"):
+        self.max_requests_per_minute = max_requests_per_minute
+        self.max_tokens_per_minute = max_tokens_per_minute
+        self.available_request_capacity = max_requests_per_minute
+        self.available_token_capacity = max_tokens_per_minute
+        self.last_update_time = time.monotonic()
+        try:
+            self.encoding = tiktoken.encoding_for_model(model)
+        except KeyError:
+            self.encoding = tiktoken.get_encoding("o200k_base")
+
+    def num_tokens_for_request(self, messages: List[Dict[str, Any]], expected_completion_tokens: int) -> int:
+        """Estimate the tokens a chat request will count against the TPM limit"""
+        num_tokens = 2  # every reply is primed with <im_start>assistant
+        for message in messages:
+            num_tokens += 4  # <im_start>{role/name}\n{content}<im_end>\n
+            for value in message.values():
+                num_tokens += len(self.encoding.encode(str(value)))
+        return num_tokens + expected_completion_tokens
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        elapsed = now - self.last_update_time
+        self.available_request_capacity = min(
+            self.available_request_capacity + self.max_requests_per_minute * elapsed / 60.0,
+            self.max_requests_per_minute,
+        )
+        self.available_token_capacity = min(
+            self.available_token_capacity + self.max_tokens_per_minute * elapsed / 60.0,
+            self.max_tokens_per_minute,
+        )
+        self.last_update_time = now
+
+    async def acquire(self, num_tokens: int) -> None:
+        """Wait until there is budget for one request of `num_tokens`, then spend it"""
+        # A request larger than the whole bucket would otherwise wait forever
+        num_tokens = min(num_tokens, self.max_tokens_per_minute)
+        while True:
+            self._refill()
+            if self.available_request_capacity >= 1 and self.available_token_capacity >= num_tokens:
+                self.available_request_capacity -= 1
+                self.available_token_capacity -= num_tokens
+                return
+            wait = max(
+                (1 - self.available_request_capacity) * 60.0 / self.max_requests_per_minute,
+                (num_tokens - self.available_token_capacity) * 60.0 / self.max_tokens_per_minute,
+                0.001,
+            )
+            logger.debug("Rate limit budget exhausted, waiting %.2fs", wait)
+            await asyncio.sleep(wait)
+
+    def on_rate_limited(self) -> None:
+        """Drain the request budget after a 429 so other callers back off too"""
+        self._refill()
+        self.available_request_capacity = min(self.available_request_capacity, 0)
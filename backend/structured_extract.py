@@ -0,0 +1,261 @@
+import re
+import logging
+from datetime import datetime
+from typing import Any, Dict, Optional, Tuple
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Contact patterns, compiled once at import
+PHONE_RE = re.compile(r"(?:\(\d{3}\)\s*|\b\d{3}[-.\s])\d{3}[-.\s]\d{4}\b")
+EMAIL_RE = re.compile(r"\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}\b")
+
+# Dates as they commonly appear on referral forms, normalized to YYYY-MM-DD
+DATE_FORMATS = (
+    "%Y-%m-%d", "%m/%d/%Y", "%m-%d-%Y", "%m/%d/%y", "%m-%d-%y", "%B %d, %Y", "%b %d, %Y", "%d %B %Y"
+)
+TWO_DIGIT_YEAR_FORMATS = {"%m/%d/%y", "%m-%d-%y"}
+DATE_RE = re.compile(
+    r"\b(?:\d{4}-\d{2}-\d{2}|\d{1,2}[/-]\d{1,2}[/-]\d{2,4}|[A-Za-z]{3,9}\.? \d{1,2}, \d{4}|\d{1,2} [A-Za-z]{3,9} \d{4})\b"
+)
+
+
+def _label(pattern: str, separator: str = r"\s*:") -> str:
+    """Wrap a label pattern with the separator that must follow it."""
+    return r"(?:" + pattern + r")" + separator
+
+
+# Labels whose value maps straight to a schema path
+LABELED_FIELDS = (
+    (_label(r"referral\s*(?:id|no\.?|number)", r"\s*[:#]"), ("referral_id",)),
+    (_label(r"referral\s*#", r"\s*:?"), ("referral_id",)),
+    (_label(r"date\s+of\s+referral|referral\s+date"), ("date_of_referral",)),
+    (_label(r"referring\s+(?:provider|physician|doctor)|referred\s+by"), ("referring_provider", "name")),
+    (_label(r"receiving\s+(?:provider|physician|doctor)|referred\s+to"), ("receiving_provider", "name")),
+    (_label(r"patient(?:\s+name)?"), ("patient", "name")),
+    (_label(r"dob|d\.o\.b\.?|date\s+of\s+birth"), ("patient", "date_of_birth")),
+    (_label(r"sex|gender"), ("patient", "gender")),
+    (_label(r"reason\s+for\s+referral|referral\s+reason"), ("reason_for_referral",)),
+    (_label(r"requested\s+action|action\s+requested"), ("requested_action",)),
+    (_label(r"diagnosis"), ("diagnosis",)),
+)
+
+# Generic labels resolved against whichever party's section we are in
+SECTION_FIELDS = (
+    (_label(r"name"), ("name",)),
+    (_label(r"phone|tel(?:ephone)?"), ("contact", "phone")),
+    (_label(r"e-?mail"), ("contact", "email")),
+    (_label(r"address"), ("contact", "address")),
+)
+
+# Every known label, so a value stops where the next label on the same line starts
+LABEL_RE = re.compile(
+    r"(?<!\S)(?:"
+    + "|".join(r"(?P<f%d>%s)" % (i, pattern) for i, (pattern, _) in enumerate(LABELED_FIELDS))
+    + "|"
+    + "|".join(r"(?P<s%d>%s)" % (i, pattern) for i, (pattern, _) in enumerate(SECTION_FIELDS))
+    + r")",
+    re.IGNORECASE,
+)
+# Any other `Label:` after a column gap, e.g. the "Date:" in "Referral #R-1042  Date: ..."
+UNKNOWN_LABEL_RE = re.compile(r"\s{2,}[A-Za-z][\w.]*(?: [\w.]+){0,3}\s*:")
+
+# What may surround a phone number or email on a line that holds only contact details
+CONTACT_LINE_RE = re.compile(r"^(?:phone|tel(?:ephone)?|cell|mobile|e-?mail|contact|[\s,;|/().:-])*$", re.IGNORECASE)
+
+# Headings that switch which party subsequent contact details belong to
+SECTION_HEADINGS = (
+    (re.compile(r"\breferring\b|\breferred\s+by\b", re.IGNORECASE), "referring_provider"),
+    (re.compile(r"\breceiving\b|\breferred\s+to\b", re.IGNORECASE), "receiving_provider"),
+    (re.compile(r"\bpatient\b", re.IGNORECASE), "patient"),
+)
+
+PARTIES = ("referring_provider", "receiving_provider", "patient")
+DATE_PATHS = {("date_of_referral",), ("patient", "date_of_birth")}
+# Values checked against a strict pattern; for everything else the LLM's reading wins
+VALIDATED_PATHS = DATE_PATHS | {
+    (party, "contact", kind) for party in PARTIES for kind in ("phone", "email")
+}
+# Fields the LLM writes in its own words rather than reading off the form, so
+# a cached copy can never be checked against another document's text
+INFERRED_FIELDS = ("summary",)
+
+
+def normalize_date(value: str, past_only: bool = False) -> Optional[str]:
+    """Return the first date in `value` as YYYY-MM-DD, or None if there is none.
+
+    Two-digit years that would land in the future are taken as last century;
+    with `past_only` (birth dates) any remaining future date is rejected.
+    """
+    match = DATE_RE.search(value)
+    if not match:
+        return None
+    text = match.group(0).replace(".", "")
+    today = datetime.now()
+    for fmt in DATE_FORMATS:
+        try:
+            parsed = datetime.strptime(text, fmt)
+        except ValueError:
+            continue
+        if fmt in TWO_DIGIT_YEAR_FORMATS and parsed > today:
+            parsed = parsed.replace(year=parsed.year - 100)
+        if past_only and parsed > today:
+            return None
+        return parsed.strftime("%Y-%m-%d")
+    return None
+
+
+def _clean_value(path: Tuple[str, ...], value: str) -> Optional[str]:
+    """Trim a labeled value and validate it for its schema path."""
+    gap = UNKNOWN_LABEL_RE.search(value)
+    if gap:
+        value = value[:gap.start()]
+    value = value.strip().lstrip(":#").strip()
+    if not value:
+        return None
+    if path in DATE_PATHS:
+        return normalize_date(value, past_only=path == ("patient", "date_of_birth"))
+    if path[-1] == "phone":
+        match = PHONE_RE.search(value)
+        return match.group(0) if match else None
+    if path[-1] == "email":
+        match = EMAIL_RE.search(value)
+        return match.group(0) if match else None
+    if path[-1] == "name" and any(char.isdigit() for char in value):
+        # Names never hold digits; this is a mis-split line, leave it to the LLM
+        return None
+    return value
+
+
+def _set_if_empty(data: Dict[str, Any], path: Tuple[str, ...], value: str) -> None:
+    """Set a nested value unless something was already extracted there."""
+    for key in path[:-1]:
+        data = data.setdefault(key, {})
+    if not data.get(path[-1]):
+        data[path[-1]] = value
+
+
+def _get(data: Dict[str, Any], path: Tuple[str, ...]) -> Any:
+    for key in path:
+        if not isinstance(data, dict):
+            return None
+        data = data.get(key)
+    return data
+
+
+def extract_structured_fields(raw_ocr_text: str) -> Dict[str, Any]:
+    """Deterministically extract the regular referral fields from OCR text.
+
+    Only fields that could be found are present in the result; everything
+    else is left for the LLM to fill in.
+    """
+    data: Dict[str, Any] = {}
+    section: Optional[str] = None
+
+    for line in raw_ocr_text.splitlines():
+        if not line.strip():
+            continue
+
+        # Only the label part of a line can switch sections, so free text like
+        # "Reason: patient reports..." does not
+        heading = line.split(":", 1)[0]
+        for pattern, party in SECTION_HEADINGS:
+            if pattern.search(heading):
+                section = party
+                break
+
+        labels = list(LABEL_RE.finditer(line))
+        for i, match in enumerate(labels):
+            end = labels[i + 1].start() if i + 1 < len(labels) else len(line)
+            kind, index = match.lastgroup[0], int(match.lastgroup[1:])
+            if kind == "f":
+                path = LABELED_FIELDS[index][1]
+            elif section is not None:
+                path = (section,) + SECTION_FIELDS[index][1]
+            else:
+                continue
+            value = _clean_value(path, line[match.end():end])
+            if value:
+                _set_if_empty(data, path, value)
+
+        # Unlabeled phone numbers and emails belong to the current section, but
+        # only on lines holding nothing else, never inside free text
+        if section is not None and not labels:
+            residue = EMAIL_RE.sub("", PHONE_RE.sub("", line))
+            if CONTACT_LINE_RE.match(residue):
+                phone = PHONE_RE.search(line)
+                if phone:
+                    _set_if_empty(data, (section, "contact", "phone"), phone.group(0))
+                email = EMAIL_RE.search(line)
+                if email:
+                    _set_if_empty(data, (section, "contact", "email"), email.group(0))
+
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Deterministic extraction found top-level fields: %s", list(data))
+    return data
+
+
+def merge_fields(base: Dict[str, Any], extra: Dict[str, Any]) -> Dict[str, Any]:
+    """Fill empty or missing values in `base` from `extra`, recursing into nested dicts."""
+    for key, value in extra.items():
+        current = base.get(key)
+        if isinstance(current, dict) and isinstance(value, dict):
+            merge_fields(current, value)
+        elif current in (None, "", [], {}):
+            base[key] = value
+    return base
+
+
+def merge_extraction(parsed: Dict[str, Any], llm: Dict[str, Any]) -> Dict[str, Any]:
+    """Combine parser and LLM output.
+
+    The LLM's reading wins for free text; parser values override it only on
+    VALIDATED_PATHS and otherwise just fill what the LLM left empty.
+    """
+    merged = merge_fields(llm, parsed)
+    for path in VALIDATED_PATHS:
+        value = _get(parsed, path)
+        if value:
+            target = merged
+            for key in path[:-1]:
+                if not isinstance(target.get(key), dict):
+                    target[key] = {}
+                target = target[key]
+            target[path[-1]] = value
+    return merged
+
+
+def _normalize_text(text: str) -> str:
+    return " ".join(text.lower().split())
+
+
+def _is_blank(value: Any) -> bool:
+    if isinstance(value, dict):
+        return all(_is_blank(item) for item in value.values())
+    return value in (None, "", [])
+
+
+def _blank_unverified(value: Any, text: str) -> Any:
+    if isinstance(value, dict):
+        return {key: _blank_unverified(item, text) for key, item in value.items()}
+    if isinstance(value, list):
+        items = (_blank_unverified(item, text) for item in value)
+        return [item for item in items if not _is_blank(item)]
+    if isinstance(value, str) and value and _normalize_text(value) not in text:
+        return ""
+    return value
+
+
+def scrub_cached_extraction(data: Dict[str, Any], raw_ocr_text: str) -> Dict[str, Any]:
+    """Blank every value in `data` that does not appear verbatim in `raw_ocr_text`.
+
+    Used on semantic cache hits, which may come from a near-identical form
+    filled in for a different patient: only what this document itself says
+    is kept, and inferred fields are dropped outright.
+    """
+    scrubbed = _blank_unverified(data, _normalize_text(raw_ocr_text))
+    for key in INFERRED_FIELDS:
+        if key in scrubbed:
+            scrubbed[key] = ""
+    return scrubbed
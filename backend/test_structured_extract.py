@@ -0,0 +1,84 @@
+from structured_extract import extract_structured_fields, merge_extraction, normalize_date, scrub_cached_extraction
+
+
+def test_value_stops_at_next_label():
+    data = extract_structured_fields(
+        "REFERRAL #R-1042  Date: 02/03/2024\n"
+        "Patient: Maria Chen  DOB: 07/19/1958\n"
+    )
+    assert data["referral_id"] == "R-1042"
+    assert data["patient"]["name"] == "Maria Chen"
+    assert data["patient"]["date_of_birth"] == "1958-07-19"
+
+
+def test_section_labels_on_one_line():
+    data = extract_structured_fields(
+        "Referring Provider Information\n"
+        "Name: Dr. Ana Ruiz  Phone: (555) 201-3344  Fax: (555) 201-9999\n"
+    )
+    assert data["referring_provider"]["name"] == "Dr. Ana Ruiz"
+    assert data["referring_provider"]["contact"]["phone"] == "(555) 201-3344"
+
+
+def test_two_digit_birth_year_is_last_century():
+    data = extract_structured_fields("DOB: 07/19/58\n")
+    assert data["patient"]["date_of_birth"] == "1958-07-19"
+
+
+def test_future_birth_date_is_rejected():
+    assert normalize_date("07/19/2999", past_only=True) is None
+    assert extract_structured_fields("Date of Birth: 07/19/2999\n") == {}
+
+
+def test_phone_in_free_text_is_not_attributed():
+    data = extract_structured_fields(
+        "Referring Provider: Dr. Ana Ruiz\n"
+        "Reason for Referral: patient's daughter asked to be called at (555) 777-1234\n"
+    )
+    assert "contact" not in data["referring_provider"]
+
+
+def test_contact_only_line_is_attributed():
+    data = extract_structured_fields(
+        "Receiving Provider: Dr. Ken Obi\n"
+        "(555) 300-4000 / ken.obi@clinic.org\n"
+    )
+    assert data["receiving_provider"]["contact"] == {"phone": "(555) 300-4000", "email": "ken.obi@clinic.org"}
+
+
+def test_llm_wins_for_free_text_parser_wins_for_validated():
+    parsed = {
+        "patient": {"name": "Maria Chen  DOB", "date_of_birth": "1958-07-19"},
+        "diagnosis": "Arrhythmia",
+    }
+    llm = {
+        "patient": {"name": "Maria Chen", "date_of_birth": "2058-07-19"},
+        "diagnosis": "",
+    }
+    merged = merge_extraction(parsed, llm)
+    assert merged["patient"] == {"name": "Maria Chen", "date_of_birth": "1958-07-19"}
+    assert merged["diagnosis"] == "Arrhythmia"
+
+
+def test_cached_values_not_in_text_are_blanked():
+    cached = {
+        "referral_id": "R-0001",
+        "patient": {"name": "John Doe", "date_of_birth": "1960-01-01", "contact": {"phone": "(555) 000-0000"}},
+        "referring_provider": {"name": "Dr. Ana Ruiz", "specialty": "Family Medicine"},
+        "reason_for_referral": "Palpitations",
+        "allergies": ["Penicillin"],
+        "medications": [{"name": "Warfarin", "dosage": "5 mg", "frequency": "daily"}],
+        "summary": "Referred to cardiology for palpitations.",
+    }
+    scrubbed = scrub_cached_extraction(
+        cached, "Referred by: Dr.  Ana Ruiz, Family Medicine\nPatient: Maria Chen\nReason: chest pain\n"
+    )
+    assert scrubbed == {
+        "referral_id": "",
+        "patient": {"name": "", "date_of_birth": "", "contact": {"phone": ""}},
+        "referring_provider": {"name": "Dr. Ana Ruiz", "specialty": "Family Medicine"},
+        "reason_for_referral": "",
+        "allergies": [],
+        "medications": [],
+        "summary": "",
+    }
@@ -0,0 +1,39 @@
+import asyncio
+import logging
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+async def _run(agent, worker_id, shutdown_event):
+    """Bridge the cross-process shutdown event into the agent's asyncio stop event."""
+    stop_event = asyncio.Event()
+
+    async def watch_shutdown():
+        await asyncio.get_running_loop().run_in_executor(None, shutdown_event.wait)
+        stop_event.set()
+
+    watcher = asyncio.create_task(watch_shutdown())
+    try:
+        await agent.supervise_agent_loop(stop_event, worker_id)
+    finally:
+        watcher.cancel()
+
+
+def run_agent_loop(worker_id, shutdown_event, num_workers=1):
+    """Process entry point: run a supervised agent loop until `shutdown_event` is set.
+
+    The agent module is imported here rather than at the top of the file, so
+    the OpenAI clients, rate limiter and semantic cache exist only in worker
+    processes. The API process still imports DocumentProcessor (for
+    validate_format, which pulls in tesserocr and cv2) and db (its own Redis
+    pool); each spawned worker builds its own copies of those, and its
+    Tesseract API is only created on first OCR.
+    """
+    import agent
+
+    logger.info("Agent worker process %d starting", worker_id)
+    agent.set_rate_limit_share(num_workers)
+    asyncio.run(_run(agent, worker_id, shutdown_event))
+    logger.info("Agent worker process %d exited", worker_id)